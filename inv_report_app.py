@@ -1,19 +1,34 @@
 import os
 import glob
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+import diskcache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 from bs4 import BeautifulSoup
 import pandas as pd
 import streamlit as st
 
-from openpyxl import Workbook
-from openpyxl.cell import MergedCell
-from openpyxl.styles import PatternFill, Alignment, Border, Side, Font
+from openpyxl import Workbook, LXML
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Alignment, Border, Side, Font, NamedStyle
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 
 
+# Shared HTTP session so the TLS connection to the price API is reused across requests
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=32,
+                                      max_retries=Retry(total=2, backoff_factor=0.2)))
+
+# Persistent cache of price API responses, shared across report runs
+PRICE_CACHE = diskcache.Cache('.price_cache')
+
+
 def get_latest_files(input_folder='inputs'):
     # Get the list of files in the folder
     files = glob.glob(os.path.join(input_folder, '*'))
@@ -33,10 +48,12 @@ def get_latest_files(input_folder='inputs'):
 
     for file in latest_files:
         if qty_file is None or amount_file is None:
-            soup = parse_html_to_soup(file)
-            if 'Opening balance' in soup.text and amount_file is None:
+            # The column headers near the top of the file are enough to tell the file type
+            with open(file, 'r', encoding='utf-8') as f:
+                head = f.read(64 * 1024)
+            if 'Opening balance' in head and amount_file is None:
                 amount_file = file
-            elif 'Opening Stock' in soup.text and qty_file is None:
+            elif 'Opening Stock' in head and qty_file is None:
                 qty_file = file
         else:
             break
@@ -48,23 +65,34 @@ def save_uploaded_file(uploadedfile, new_extension=None):
     """ Save the uploaded file temporarily and return the file path.
         If new_extension is provided, rename the file with that extension.
     """
+    uploadedfile.seek(0)
     with tempfile.NamedTemporaryFile(delete=False, suffix=new_extension if new_extension else '') as tmp_file:
-        tmp_file.write(uploadedfile.getbuffer())
+        # Copy in 1 MiB chunks rather than materializing the whole upload in memory
+        shutil.copyfileobj(uploadedfile, tmp_file, length=1 << 20)
         return tmp_file.name
 
 
+@st.cache_resource(max_entries=4, ttl=3600)
+def build_soup(html_content):
+    """ Parse the HTML content using BeautifulSoup with the lxml parser.
+        Cached by content, so re-running the report on the same upload skips the parse.
+    """
+    return BeautifulSoup(html_content, 'lxml')
+
+
 def parse_html_to_soup(html_file_path):
     # Read the HTML file
     with open(html_file_path, 'r', encoding='utf-8') as file:
         html_content = file.read()
 
-    # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Parse the HTML content (or reuse the cached tree for identical content)
+    soup = build_soup(html_content)
 
-    return soup
+    # Return the raw content as well so it can be validated without walking the tree
+    return soup, html_content
 
 
-def soup_to_dataframe(soup, is_amount_file=False):
+def soup_to_dataframe(soup, is_amount_file=False, warehouse_filter=None):
     # Find the table in the parsed HTML
     table = soup.find('table', {'id': 'TableResult'})
 
@@ -75,14 +103,26 @@ def soup_to_dataframe(soup, is_amount_file=False):
 
     # Process the table rows
     for row in table.find_all('tr'):
+        # Look up the row's cells once and branch on the first one
+        tds = row.find_all('td')
+        if not tds:
+            continue
+        first = tds[0]
+
         # Identify item rows
-        if row.find('td') and row.find('td').get('colspan') == '15':
-            current_item = row.get_text(strip=True).replace('ITEM : ', '')
+        if first.get('colspan') == '15':
+            item_text = first.get_text(strip=True)
+            current_item = item_text[7:] if item_text.startswith('ITEM : ') else item_text
 
         # Process warehouse data rows
-        elif row.find('td') and not row.find('td').get('colspan'):
-            warehouse_name = row.find_all('td')[0].get_text(strip=True)
-            data = [td.get_text(strip=True) for td in row.find_all('td')]
+        elif not first.get('colspan'):
+            warehouse_name = first.get_text(strip=True)
+
+            # Skip warehouses outside the filter before extracting the row data
+            if warehouse_filter and warehouse_filter not in warehouse_name:
+                continue
+
+            data = [warehouse_name] + [td.get_text(strip=True) for td in tds[1:]]
 
             items.append(current_item)
             warehouses.append(warehouse_name)
@@ -106,69 +146,111 @@ def soup_to_dataframe(soup, is_amount_file=False):
     # Create DataFrame
     df = pd.DataFrame(data_rows, columns=columns)
 
-    # Add the item column to the DataFrame
-    df['Item'] = items
-    df['Warehouse Name'] = warehouses
+    # Convert the figures from text to numbers once (dropping thousands separators)
+    numeric_cols = columns[1:]
+    df[numeric_cols] = df[numeric_cols].apply(
+        lambda col: pd.to_numeric(col.str.replace(',', '', regex=False), errors='coerce')
+    ).astype('float64')
+
+    # Add the item column to the DataFrame (as strings even when no rows matched, so .str works downstream)
+    df['Item'] = pd.Series(items, index=df.index, dtype=object)
+    df['Warehouse Name'] = pd.Series(warehouses, index=df.index, dtype=object)
 
     return df
 
 
-def get_unit_price(item_code):
-    """
-    Fetch the unit price using the provided API.
+def get_subminor_code(item_code):
+    """ Extract the SubminorCode from an item code (e.g., '6_2' from '6_2_1') """
+    return "_".join(item_code.split("_")[:2])
 
-    Parameters:
-        item_code (str): The code of the item to fetch the price for.
 
-    Returns:
-        float: The unit price of the item, or 0 if not found.
+@PRICE_CACHE.memoize(expire=86400)
+def _fetch_subminor(subminor_code):
+    """
+    Request the unit prices of every item under a SubminorCode from the API.
+    Results are memoized on disk for a day; failed requests (including a
+    non-Success API status) raise and are therefore never cached.
     """
-    # Extract the SubminorCode (e.g., '6_2' from '6_2_1')
-    subminor_code = "_".join(item_code.split("_")[:2])
-
     # Define the API endpoint
     api_url = "https://tasleeh-ims.com:8023/api/apis/GeItemSegregationBySubMinorCode"
 
     # Set up the parameters for the request
     params = {'SubminorCode': subminor_code}
 
-    try:
-        # Make the GET request to the API
-        response = requests.get(api_url, params=params)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+    # Make the GET request to the API
+    response = SESSION.get(api_url, params=params, timeout=(3, 10))
+    response.raise_for_status()  # Raise an exception for HTTP errors
+
+    # Parse the JSON response
+    data = response.json()
 
-        # Parse the JSON response
-        data = response.json()
+    # Check if the API returned a success status
+    if data['Status'] != 'Success':
+        raise requests.exceptions.RequestException(
+            f"API returned status {data['Status']!r}", response=response)
 
-        # Check if the API returned a success status
-        if data['Status'] == 'Success':
-            # Iterate through the items in the response data
-            for item in data['Data']:
-                if item['ItemCode'] == item_code:
-                    return item['BaseUOMUnitPrice']  # Return the desired price
+    # Build the price lookup in a single pass over the response data
+    return {item['ItemCode']: item['BaseUOMUnitPrice'] for item in data['Data']}
 
-        # If the item was not found, return 0
-        return 0.0
 
+def fetch_subminor_prices(subminor_code):
+    """
+    Fetch the unit prices of every item under a SubminorCode using the provided API.
+
+    Parameters:
+        subminor_code (str): The SubminorCode to fetch the prices for.
+
+    Returns:
+        dict: A mapping of item code to unit price, empty if the request failed.
+    """
+    try:
+        return _fetch_subminor(subminor_code)
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching unit price for {item_code}: {e}")
-        return 0.0
+        print(f"Error fetching unit prices for {subminor_code}: {e}")
+        return {}
+
+
+def get_unit_price(item_code):
+    """
+    Fetch the unit price using the provided API.
+
+    Parameters:
+        item_code (str): The code of the item to fetch the price for.
+
+    Returns:
+        float: The unit price of the item, or 0 if not found.
+    """
+    prices = fetch_subminor_prices(get_subminor_code(item_code))
+    return prices.get(item_code, 0.0)
 
 
 def add_unit_price_column(df):
     """
     Add a unit price column to the DataFrame using item codes.
 
+    The API is queried once per unique SubminorCode rather than once per row,
+    with the requests spread over a small thread pool.
+
     Parameters:
         df (pd.DataFrame): The DataFrame to add the unit price to.
 
     Returns:
         pd.DataFrame: The DataFrame with the added unit price column.
     """
-    df = df.copy()
-    df.loc[:, 'Item Code'] = df['Item'].apply(lambda x: x.split(' - ')[0])
-    df.loc[:, 'Unit Price'] = df['Item Code'].apply(get_unit_price)
-    return df
+    codes = df['Item'].apply(lambda x: x.split(' - ')[0])
+
+    # Fetch prices for each SubminorCode only once
+    subminor_codes = {get_subminor_code(code) for code in codes.unique()}
+    price_map = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for prices in executor.map(fetch_subminor_prices, subminor_codes):
+            price_map.update(prices)
+
+    # Return a new frame with the two added columns rather than copying and then assigning via .loc
+    return df.assign(**{
+        'Item Code': codes,
+        'Unit Price': codes.map(price_map).fillna(0.0).astype('float64'),
+    })
 
 
 def merge_dataframes(qty_df, amount_df):
@@ -194,8 +276,8 @@ def merge_dataframes(qty_df, amount_df):
     organized_df = merged_df[
         [
             'Item', 'Opening Stock', 'Unit Price', 'Opening Balance Amount',
-            'Purchase Stock', 'Unit Price', 'Total Purchase',
-            'Sales Stock', 'Unit Price', 'Total Sales',
+            'Purchase Stock', 'Total Purchase',
+            'Sales Stock', 'Total Sales',
             'Closing Stock', 'Closing Balance Amount'
         ]
     ]
@@ -204,69 +286,22 @@ def merge_dataframes(qty_df, amount_df):
 
 
 def apply_excel_formatting(df, output_file):
-    # Create a new workbook and select the active worksheet
-    wb = Workbook()
-    ws = wb.active
+    # Write-only mode streams rows straight to disk; it relies on lxml to do so quickly
+    if not LXML:
+        raise ImportError("lxml must be installed to write the Excel report")
 
-    # Add the data to the worksheet
-    for r_idx, row in enumerate(dataframe_to_rows(df, index=False, header=True), start=2):
-        for c_idx, value in enumerate(row, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=value)
+    # Create a streaming workbook and worksheet
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Report")
 
-    # Merge cells for the headers
-    ws.merge_cells('B1:D1')
-    ws['B1'] = 'OPENING'
-
-    ws.merge_cells('E1:G1')
-    ws['E1'] = 'PURCHASE'
-
-    ws.merge_cells('H1:J1')
-    ws['H1'] = 'SALES'
-
-    ws.merge_cells('K1:L1')
-    ws['K1'] = 'CLOSING STOCK'
-
-    # Apply styles for headers
+    # Create the styles once and share them across all cells
     fill_opening = PatternFill(start_color="ADD8E6", end_color="ADD8E6", fill_type="solid")
     fill_purchase = PatternFill(start_color="F4CCCC", end_color="F4CCCC", fill_type="solid")
     fill_sales = PatternFill(start_color="D9EAD3", end_color="D9EAD3", fill_type="solid")
     fill_closing = PatternFill(start_color="EAD1DC", end_color="EAD1DC", fill_type="solid")
 
     bold_font = Font(bold=True)  # Create a bold font
-
-    # Apply fills and bold font to merged cells
-    ws['B1'].fill = fill_opening
-    ws['B1'].font = bold_font
-    ws['E1'].fill = fill_purchase
-    ws['E1'].font = bold_font
-    ws['H1'].fill = fill_sales
-    ws['H1'].font = bold_font
-    ws['K1'].fill = fill_closing
-    ws['K1'].font = bold_font
-
-    # Apply alignment to the merged cells
     alignment = Alignment(horizontal="center", vertical="center")
-    ws['B1'].alignment = alignment
-    ws['E1'].alignment = alignment
-    ws['H1'].alignment = alignment
-    ws['K1'].alignment = alignment
-
-    # Apply cell colors to corresponding columns
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=2, max_col=4):
-        for cell in row:
-            cell.fill = fill_opening
-
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=5, max_col=7):
-        for cell in row:
-            cell.fill = fill_purchase
-
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=8, max_col=10):
-        for cell in row:
-            cell.fill = fill_sales
-
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=11, max_col=12):
-        for cell in row:
-            cell.fill = fill_closing
 
     # Define border style
     thin_border = Border(left=Side(style='thin'),
@@ -274,39 +309,60 @@ def apply_excel_formatting(df, output_file):
                          top=Side(style='thin'),
                          bottom=Side(style='thin'))
 
-    # Apply border to all cells
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column):
-        for cell in row:
-            cell.border = thin_border
-
-    # Auto-adjust column widths based on the maximum length of data in each column
-    for col in ws.columns:
-        max_length = 0
-        column_letter = None
-
-        for cell in col:
-            if not isinstance(cell, MergedCell):
-                if column_letter is None:
-                    column_letter = cell.column_letter  # Get the column letter from the first non-merged cell
-
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
+    # Column blocks and their fills (1-based, inclusive)
+    blocks = [(2, 4, 'opening', fill_opening), (5, 6, 'purchase', fill_purchase),
+              (7, 8, 'sales', fill_sales), (9, 10, 'closing', fill_closing)]
+
+    # Register the cell styles as named styles so each cell only references a style index,
+    # and record which style each column uses (indexed by 1-based column number)
+    wb.add_named_style(NamedStyle('report_body', border=thin_border))
+    col_style = ['report_body'] * (len(df.columns) + 1)
+    header_style = {}
+    for min_col, max_col, name, fill in blocks:
+        wb.add_named_style(NamedStyle(f'{name}_header', fill=fill, font=bold_font,
+                                      alignment=alignment, border=thin_border))
+        wb.add_named_style(NamedStyle(f'{name}_body', fill=fill, border=thin_border))
+        header_style[min_col] = f'{name}_header'
+        for c_idx in range(min_col, max_col + 1):
+            col_style[c_idx] = f'{name}_body'
+
+    # Labels for the merged block headers, keyed by column
+    header_labels = {2: 'OPENING', 5: 'PURCHASE', 7: 'SALES', 9: 'CLOSING STOCK'}
+
+    # Column widths from the DataFrame; these must be set before any row is written in write-only mode
+    value_lengths = df.astype(str).apply(lambda column: column.str.len()).max().astype(float).fillna(0).astype(int)
+    for c_idx, (name, length) in enumerate(zip(df.columns, value_lengths), start=1):
+        width = max(len(str(name)), len(header_labels.get(c_idx, '')), length) + 2
+        ws.column_dimensions[get_column_letter(c_idx)].width = width
+
+    # Header row: bold, centred block labels over merged cells
+    header_row = []
+    for c_idx in range(1, len(df.columns) + 1):
+        cell = WriteOnlyCell(ws, value=header_labels.get(c_idx))
+        cell.style = header_style.get(c_idx, 'report_body')
+        header_row.append(cell)
+    ws.append(header_row)
+
+    # Data rows, styled as they are written
+    for row in dataframe_to_rows(df, index=False, header=True):
+        cells = []
+        for c_idx, value in enumerate(row, start=1):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = col_style[c_idx]
+            cells.append(cell)
+        ws.append(cells)
 
-        if column_letter:
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column_letter].width = adjusted_width
+    # Merge cells for the headers (written out when the workbook is saved)
+    for min_col, max_col, _, _ in blocks:
+        ws.merged_cells.add(f"{get_column_letter(min_col)}1:{get_column_letter(max_col)}1")
 
     # Save the formatted workbook
     wb.save(output_file)
 
 
-def validate_file_content(soup, expected_keywords):
-    """ Validate the content of the HTML file by checking for expected keywords """
-    text_content = soup.get_text(strip=True)
-    return all(keyword in text_content for keyword in expected_keywords)
+def validate_file_content(html_content, expected_keywords):
+    """ Validate the content of the HTML file by checking its raw text for expected keywords """
+    return all(keyword in html_content for keyword in expected_keywords)
 
 def main():
     st.title("Automated Report Generator")
@@ -337,32 +393,28 @@ def main():
             progress_bar.progress(progress)
 
             # Parse the files
-            qty_soup = parse_html_to_soup(qty_file_path)
-            amount_soup = parse_html_to_soup(amount_file_path)
+            qty_soup, qty_html = parse_html_to_soup(qty_file_path)
+            amount_soup, amount_html = parse_html_to_soup(amount_file_path)
 
             # Validate the file contents
-            if not validate_file_content(qty_soup, ["Opening Stock"]):
+            if not validate_file_content(qty_html, ["Opening Stock"]):
                 st.error("The Quantity file does not appear to be correct. Please upload the correct Quantity file.")
                 return
 
-            if not validate_file_content(amount_soup, ["Opening balance"]):
+            if not validate_file_content(amount_html, ["Opening balance"]):
                 st.error("The Amount file does not appear to be correct. Please upload the correct Amount file.")
                 return
 
             progress += 20
             progress_bar.progress(progress)
 
-            # Convert the parsed HTML to DataFrames
-            qty_df = soup_to_dataframe(qty_soup, is_amount_file=False)
-            amount_df = soup_to_dataframe(amount_soup, is_amount_file=True)
+            # Convert the parsed HTML to DataFrames, keeping 'WS1 - WS Shuwaikh' rows only
+            qty_df = soup_to_dataframe(qty_soup, is_amount_file=False, warehouse_filter='WS1 - WS Shuwaikh')
+            amount_df = soup_to_dataframe(amount_soup, is_amount_file=True, warehouse_filter='WS1 - WS Shuwaikh')
 
             progress += 20
             progress_bar.progress(progress)
 
-            # Filter for 'WS1 - WS Shuwaikh' rows only
-            qty_df = qty_df[qty_df['Warehouse Name'].str.contains('WS1 - WS Shuwaikh', na=False)]
-            amount_df = amount_df[amount_df['Warehouse Name'].str.contains('WS1 - WS Shuwaikh', na=False)]
-
             # Add Unit Price column
             qty_df = add_unit_price_column(qty_df)
 